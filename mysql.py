@@ -1,40 +1,147 @@
-import pymysql, json, enum
+import json, enum, copy, functools, logging, queue, re, sys, threading, time
+from contextlib import contextmanager
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Callable, Iterable, Generic, TypeVar, Union, Any, overload
+from typing import Callable, Iterable, Iterator, Generic, TypeVar, Union, Any, overload, TYPE_CHECKING
 from typing_extensions import Self
 
+if TYPE_CHECKING:
+    import pandas
+
+# mysqlclient parses packets in C; PyMySQL is the pure Python fallback with the same DB-API surface.
+try:
+    import MySQLdb as _driver
+    import MySQLdb.cursors as _cursors
+except ImportError:
+    import pymysql as _driver
+    import pymysql.cursors as _cursors
+    from pymysql.constants import CLIENT as _CLIENT
+else:
+    from MySQLdb.constants import CLIENT as _CLIENT
+
+
+_log = logging.getLogger(__name__)
+
 
 # == SESSION == #
 class _Session:
     query: str = ''
 
-    def __init__(self, host, user, password, database, charset="utf8") -> None:
+    def __init__(
+        self,
+        host,
+        user,
+        password,
+        database,
+        charset="utf8",
+        init_command: str | None = None,
+        multi_statements: bool = False
+    ) -> None:
         self.conn = None
         self.kwargs = dict(
             host=host,
             user=user,
             password=password,
             database=database,
-            charset=charset
+            charset=charset,
+            autocommit=True
         )
-
-    def connect(self) -> Self:
-        self.conn = pymysql.connect(**self.kwargs)
-        self.cursor = self.conn.cursor(pymysql.cursors.DictCursor)
+        self.in_transaction = False
+        "`bool`: Whether a `transaction` block is open on this session."
+        self.init_command = init_command
+        "`str | None`: A single SQL statement run once per connection, sent together with the first query instead of on its own."
+        self._pending_init: str | None = None
+        self.multi_statements = bool(init_command or multi_statements)
+        "`bool`: Whether several statements can be sent in a single query."
+
+        if self.multi_statements:
+            self.kwargs["client_flag"] = _CLIENT.MULTI_STATEMENTS
+
+    def connect(self, streaming: bool = False) -> Self:
+        "If `streaming` is set, the session cursor is unbuffered and rows are read from the server as they are fetched."
+        self.conn = _driver.connect(**self.kwargs)
+        self._pending_init = self.init_command or None
+        if streaming:
+            self.cursor = self.conn.cursor(_cursors.SSDictCursor)
+        else:
+            self.cursor = self.conn.cursor(_cursors.DictCursor)
         return self
 
-    def execute(self, query: str, commit: bool = False) -> None:
+    def ping(self) -> None:
+        "Checks that the connection is alive and reconnects if it is not."
+        try:
+            self.conn.ping()
+        except _driver.Error:
+            # PyMySQL raises a plain `Error` ("Already closed") once it has closed the socket of a dropped connection.
+            self.connect()
+
+    def _run(self, cursor, query: str, params: Iterable[Any] | None) -> int:
+        "Executes `query` on `cursor`, preceded by the init command if the connection hasn't run it yet."
+        if self._pending_init is None:
+            return cursor.execute(query, params)
+
+        init, self._pending_init = self._pending_init, None
+        if params is not None:
+            init = init.replace('%', '%%')
+        cursor.execute(f'{init};\n{query}', params)
+
+        # Skip the result of the init command, leaving the cursor on the result of `query`.
+        # Only once: mysqlclient's `nextset` fetches the current result before moving on, which would drop the rows of `query`.
+        cursor.nextset()
+        return cursor.rowcount
+
+    def execute(self, query: str, params: Iterable[Any] | None = None, cursor=None) -> None:
+        "Runs `query` on the session cursor, or on `cursor` if one is given."
         try:
-            print(f'OK, Affected rows: {self.cursor.execute(query)}')
+            if cursor is None:
+                cursor = self.cursor
+            rows = self._run(cursor, query, params)
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug("OK, Affected rows: %d", rows)
             _Session.query = query
-            if commit:
-                self.conn.commit()
         except AttributeError:
             raise RuntimeError("Session is not connected")
         except Exception as e:
-            print(query)
+            _log.error("Failed query: %s", query)
             raise e
 
+    def executemany(self, query: str, params: Iterable[Iterable[Any]]) -> None:
+        try:
+            if self._pending_init is not None:
+                # The driver only batches a statement that starts with INSERT, so the init command goes first on its own.
+                self.cursor.execute(self._pending_init)
+                self._pending_init = None
+            rows = self.cursor.executemany(query, params)
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug("OK, Affected rows: %d", rows)
+            _Session.query = query
+        except AttributeError:
+            raise RuntimeError("Session is not connected")
+        except Exception as e:
+            _log.error("Failed query: %s", query)
+            raise e
+
+    def stream(self, query: str, params: Iterable[Any] | None = None, batch_size: int | None = None) -> Iterator[dict[str, Any]]:
+        """Yields the rows of `query` from a separate unbuffered cursor.
+        With `batch_size`, rows are read in chunks of that size instead of one at a time."""
+        try:
+            cursor = self.conn.cursor(_cursors.SSDictCursor)
+        except AttributeError:
+            raise RuntimeError("Session is not connected")
+
+        try:
+            self._run(cursor, query, params)
+            _Session.query = query
+            if batch_size is None:
+                yield from cursor
+            else:
+                while rows := cursor.fetchmany(batch_size):
+                    yield from rows
+        finally:
+            cursor.close()
+
     def disconnect(self) -> None:
         self.conn.close()
         self.conn = None
@@ -47,14 +154,169 @@ class _Session:
         self.disconnect()
 
 
-_sessions: list[_Session | None] = [None]
+class _Pool:
+    ping_interval: float = 30.0
+    "`float`: Seconds a session may stay idle before it is pinged (and reconnected if needed) on checkout."
+    acquire_timeout: float = 30.0
+    "`float`: Seconds to wait for a session when all `max_size` of them are checked out."
 
-def set_session(host, user, password, database, charset="utf8") -> _Session:
-    _sessions[0] = _Session(host, user, password, database, charset)
-    return _sessions[0]
+    def __init__(self, kwargs: dict[str, Any], min_size: int, max_size: int) -> None:
+        self.kwargs = kwargs
+        self.max_size = max_size
+        self.sessions: list[_Session] = [_Session(**kwargs) for _ in range(min_size)]
+        self.idle: queue.LifoQueue[tuple[_Session, float]] = queue.LifoQueue()
+        self.lock = threading.Lock()
+
+        for sess in self.sessions:
+            self.idle.put((sess, time.monotonic()))
+
+    def acquire(self) -> _Session:
+        try:
+            sess, released = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                if len(self.sessions) < self.max_size:
+                    sess, released = _Session(**self.kwargs), time.monotonic()
+                    self.sessions.append(sess)
+                else:
+                    sess = None
+
+            if sess is None:
+                try:
+                    sess, released = self.idle.get(timeout=self.acquire_timeout)
+                except queue.Empty:
+                    raise RuntimeError(f"No session was released within {self.acquire_timeout} seconds; all {self.max_size} are in use") from None
+
+        try:
+            if sess.conn is None:
+                sess.connect()
+            elif time.monotonic() - released > self.ping_interval:
+                sess.ping()
+        except Exception:
+            self.release(sess)
+            raise
+        return sess
+
+    def release(self, sess: _Session) -> None:
+        self.idle.put((sess, time.monotonic()))
+
+
+_pool: _Pool | None = None
+_current_session: ContextVar[_Session | None] = ContextVar("_current_session", default=None)
+
+
+_verbose_handler = logging.StreamHandler(sys.stdout)
+_verbose_handler.setFormatter(logging.Formatter("%(message)s"))
+
+
+def set_verbose(verbose: bool = True) -> None:
+    "Prints the affected row count of every query to stdout, as older versions always did."
+    if verbose:
+        if _verbose_handler not in _log.handlers:
+            _log.addHandler(_verbose_handler)
+        _log.setLevel(logging.DEBUG)
+    else:
+        _log.removeHandler(_verbose_handler)
+        _log.setLevel(logging.NOTSET)
+
+
+def set_session(
+    host,
+    user,
+    password,
+    database,
+    charset="utf8",
+    min_size: int = 1,
+    max_size: int = 10,
+    *,
+    init_command: str | None = None,
+    multi_statements: bool = False
+) -> _Session:
+    """Sets up a pool of up to `max_size` sessions. `min_size` sessions are created up front and connect on first use.
+    `init_command` (e.g. `SET time_zone = '+00:00'`) is sent with the first query of every connection.
+    `multi_statements` lets `create_tables` send all tables at once; it's implied by `init_command`.
+    Returns the first of them."""
+    global _pool
+
+    if not 1 <= min_size <= max_size:
+        raise ValueError("min_size must be at least 1 and not greater than max_size")
+
+    _pool = _Pool(
+        dict(
+            host=host,
+            user=user,
+            password=password,
+            database=database,
+            charset=charset,
+            init_command=init_command,
+            multi_statements=multi_statements
+        ),
+        min_size,
+        max_size
+    )
+    return _pool.sessions[0]
+
+
+@contextmanager
+def _acquire(share: bool = True) -> Iterator[_Session]:
+    """Checks a session out of the pool for the duration of the block.
+    Nested blocks reuse the session that is already checked out, unless `share` is false on the outer one."""
+    if (sess := _current_session.get()) is not None:
+        yield sess
+        return
+
+    if _pool is None:
+        raise RuntimeError("Session is not set")
+
+    sess = _pool.acquire()
+    token = _current_session.set(sess) if share else None
+    try:
+        yield sess
+    finally:
+        if token is not None:
+            _current_session.reset(token)
+        _pool.release(sess)
+
+
+@contextmanager
+def transaction() -> Iterator[_Session]:
+    """Runs the queries of the block in a single transaction on one session.
+    It is committed when the block ends and rolled back if it raises. Sessions are in autocommit mode otherwise."""
+    with _acquire() as sess:
+        if sess.in_transaction:
+            raise RuntimeError("Transaction is already open")
+
+        sess.conn.begin()
+        sess.in_transaction = True
+        try:
+            yield sess
+        except BaseException:
+            sess.conn.rollback()
+            raise
+        else:
+            sess.conn.commit()
+        finally:
+            sess.in_transaction = False
 
 
 # == DATA TYPES == #
+_ESCAPE_TABLE = str.maketrans({"'": "\\'", '"': '\\"', '\\': '\\\\', '\x00': '\\0'})
+"Escapes quotes, backslashes and NUL in a single pass for string literals."
+
+# Shared converters, so no closure is created per type and each call is a plain function call.
+_to_str = str
+_to_int = int
+_to_float = float
+
+
+def _bits_to_int(value: bytes) -> int:
+    return int.from_bytes(value, "big")
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
 class DataType:
     def __init__(self, size: int) -> None:
         self.size = size
@@ -65,6 +327,10 @@ class DataType:
     
     def to_sql(self, value: Any) -> Any:
         return "'%s'" % value
+
+    def to_param(self, value: Any) -> Any:
+        "Returns the value to bind to a `%s` placeholder. Quoting is left to the driver."
+        return value
     
     def default_format(self, value: Any) -> str:
         return self.to_sql(value)
@@ -76,13 +342,21 @@ class StringType(DataType):
         self.definition = f'char({size})' if fixed else f'varchar({size})'
 
         if convert:
-            self.to_python = lambda x: str(x)
+            self.to_python = _to_str
     
     def to_sql(self, value: Any) -> Any:
         if isinstance(value, str):
-            return "'{}'".format(value.replace("'", "\\'").replace('"', '\\"'))
+            return "'" + value.translate(_ESCAPE_TABLE) + "'"
         elif isinstance(value, bytes):
-            return "'{}'".format(value.decode().replace("'", "\\'").replace('"', '\\"'))
+            return "'" + value.decode('utf-8', 'surrogateescape').translate(_ESCAPE_TABLE) + "'"
+        else:
+            raise TypeError(f'Cannot convert {value} to SQL')
+
+    def to_param(self, value: Any) -> str:
+        if isinstance(value, str):
+            return value
+        elif isinstance(value, bytes):
+            return value.decode()
         else:
             raise TypeError(f'Cannot convert {value} to SQL')
 
@@ -102,7 +376,7 @@ class TextType(DataType):
             raise ValueError("size must be 0, 1, 2, or 3")
 
         if convert:
-            self.to_python = lambda x: str(x)
+            self.to_python = _to_str
 
 
 _E = TypeVar("_E")
@@ -113,7 +387,12 @@ class EnumType(DataType, Generic[_E]):
         self.definition = f'enum({", ".join(map(self.to_sql, enum_class._member_names_))})'
         self.enum_class = enum_class
 
-        self.to_python = lambda x: enum_class(x)
+        self.to_python = enum_class
+
+    def to_param(self, value: _E | str) -> str:
+        if isinstance(value, enum.Enum):
+            return value.name
+        return value
 
     def default_format(self, value: _E) -> str:
         return self.to_sql(str(value))
@@ -137,6 +416,15 @@ class SetType(DataType):
         else:
             raise TypeError(f'Cannot convert {value} to SQL')
 
+    def to_param(self, value: Iterable[str] | str) -> str:
+        if isinstance(value, str):
+            return value
+        elif isinstance(value, Iterable):
+            # Members are read back by value in `to_python`, so they are written by value too.
+            return ','.join(str(v.value) if isinstance(v, enum.Enum) else str(v) for v in value)
+        else:
+            raise TypeError(f'Cannot convert {value} to SQL')
+
 
 TINYINT = 1
 "`IntegerType`: 1 byte, -128 to 127"
@@ -175,14 +463,15 @@ class IntegerType(DataType):
             self.definition = "bigint"
         else:
             raise ValueError("size must be 1, 2, 3, 4, or 8")
-        
+
+        self.unsigned = unsigned
         if unsigned:
             self.definition += " unsigned"
 
         if convert:
-            self.to_python = lambda x: int(x)
+            self.to_python = _to_int
         
-        self.to_sql = lambda x: str(x)
+        self.to_sql = _to_str
 
     def default_format(self, value: int) -> str:
         return "'%d'" % value
@@ -205,6 +494,13 @@ class BooleanType(DataType):
         else:
             raise TypeError(f'Cannot convert {value} to SQL')
 
+    @classmethod
+    def to_param(cls, value: bool | int) -> bool:
+        if isinstance(value, (int, bool)):
+            return bool(value)
+        else:
+            raise TypeError(f'Cannot convert {value} to SQL')
+
     @classmethod
     def default_format(cls, value: bool) -> str:
         return cls.to_sql(value)
@@ -229,9 +525,9 @@ class FloatType(DataType):
             self.definition += " unsigned"
         
         if convert:
-            self.to_python = lambda x: float(x)
+            self.to_python = _to_float
         
-        self.to_sql = lambda x: str(x)
+        self.to_sql = _to_str
     
     def default_format(self, value: float) -> str:
         return "'%f'" % value
@@ -246,9 +542,9 @@ class DecimalType(DataType):
             self.definition += " UNSIGNED"
 
         if convert:
-            self.to_python = lambda x: x
+            self.to_python = _identity
 
-        self.to_sql = lambda x: str(x)
+        self.to_sql = _to_str
 
 
 class BitType(DataType):
@@ -257,7 +553,7 @@ class BitType(DataType):
         self.definition = f'bit({size})'
 
         if convert:
-            self.to_python = lambda x: int.from_bytes(x, "big")
+            self.to_python = _bits_to_int
         
     def to_sql(self, value: int | bytes | str) -> str:
         if isinstance(value, int):
@@ -269,6 +565,16 @@ class BitType(DataType):
         else:
             raise TypeError(f'Cannot convert {value} to SQL')
 
+    def to_param(self, value: int | bytes | str) -> int:
+        if isinstance(value, int):
+            return value
+        elif isinstance(value, bytes):
+            return int.from_bytes(value, "big")
+        elif isinstance(value, str):
+            return int(value.removeprefix("b").strip("'"), 2)
+        else:
+            raise TypeError(f'Cannot convert {value} to SQL')
+
 
 class JsonType(DataType):
     definition = "json"
@@ -284,6 +590,10 @@ class JsonType(DataType):
     def to_sql(cls, value: Any) -> Any:
         return json.dumps(value)
 
+    @classmethod
+    def to_param(cls, value: Any) -> str:
+        return json.dumps(value)
+
 
 class TimeStampType(DataType):
     def __init__(self, current_timestamp: bool = True) -> None:
@@ -310,6 +620,35 @@ class TimeStampType(DataType):
         else:
             raise TypeError(f'Cannot convert {value} to SQL')
 
+    def to_param(self, value: Any) -> datetime | str:
+        if isinstance(value, (datetime, str)):
+            return value
+        elif isinstance(value, int):
+            return datetime.fromtimestamp(value)
+        else:
+            raise TypeError(f'Cannot convert {value} to SQL')
+
+
+def _cast_column(column: "pandas.Series", type: DataType) -> "pandas.Series":
+    "Casts a data frame column to the dtype matching `type`. Columns of other types are left as fetched."
+    import pandas
+
+    nulls = column.isna().any()
+    if type is BooleanType:
+        return column.astype("boolean" if nulls else "bool")
+    elif isinstance(type, IntegerType):
+        # BIGINT UNSIGNED goes up to 2^64 - 1, which doesn't fit in int64.
+        if type.unsigned:
+            return column.astype("UInt64" if nulls else "uint64")
+        return column.astype("Int64" if nulls else "int64")
+    elif isinstance(type, FloatType):
+        return column.astype("float64")
+    elif isinstance(type, TimeStampType):
+        return pandas.to_datetime(column)
+    elif isinstance(type, EnumType):
+        return pandas.Categorical(column, categories=type.enum_class._member_names_)
+    return column
+
 
 # == MODEL == #
 class RawFormat:
@@ -320,70 +659,97 @@ class RawFormat:
         return self.value
 
 
+_IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_$]*')
+
+
+def _escape_percent(text: str) -> str:
+    "Escapes `%` in raw SQL so the driver's %-formatting leaves it as is."
+    return text.replace('%', '%%')
+
+
 class _SelectQuery:
     def __init__(self, field: "_FieldBase" = None) -> None:
-        if field is None:
-            self.query = ''
-        else:
-            self.query = str(field)
+        self._parts: list[str] = [] if field is None else [str(field)]
+        self._params: list[Any] = []
+
+    @property
+    def query(self) -> str:
+        return ''.join(self._parts)
 
     def __add__(self, __value: str | Self) -> Self:
         if isinstance(__value, str):
-            self.query += __value
+            self._parts.append(_escape_percent(__value))
         elif isinstance(__value, _SelectQuery):
-            self.query += str(__value)
+            self._parts.extend(__value._parts)
+            self._params.extend(__value._params)
         else:
             return NotImplemented
         return self
 
+    def _operand(self, __value: Any) -> str:
+        "Returns fields, raw SQL and nested queries as text, and binds any other value to a placeholder."
+        if isinstance(__value, _SelectQuery):
+            self._params.extend(__value._params)
+        elif isinstance(__value, RawFormat):
+            return _escape_percent(__value.value)
+        elif not isinstance(__value, _FieldBase):
+            self._params.append(__value)
+            return '%s'
+        return str(__value)
+
     def __eq__(self, __value: Any) -> Self:
-        self.query += f' = \'{__value}\''
+        self._parts.append(f' = {self._operand(__value)}')
         return self
     
     def __gt__(self, __value: Any) -> Self:
-        self.query += f' > {__value}'
+        self._parts.append(f' > {self._operand(__value)}')
         return self
     
     def __lt__(self, __value: Any) -> Self:
-        self.query += f' < {__value}'
+        self._parts.append(f' < {self._operand(__value)}')
         return self
     
     def __ge__(self, __value: Any) -> Self:
-        self.query += f' >= {__value}'
+        self._parts.append(f' >= {self._operand(__value)}')
         return self
     
     def __le__(self, __value: Any) -> Self:
-        self.query += f' <= {__value}'
+        self._parts.append(f' <= {self._operand(__value)}')
         return self
     
     def __ne__(self, __value: Any) -> Self:
-        self.query += f' != \'{__value}\''
+        self._parts.append(f' != {self._operand(__value)}')
         return self
     
     def __str__(self) -> str:
-        return self.query
+        return ''.join(self._parts)
     
     def __and__(self, __value: Any) -> Self:
-        self.query += f' AND {__value}'
+        self._parts.append(f' AND {self._condition(__value)}')
         return self
     
     def __or__(self, __value: Any) -> Self:
-        self.query += f' OR {__value}'
+        self._parts.append(f' OR {self._condition(__value)}')
         return self
     
     def __invert__(self) -> Self:
-        self.query = f'NOT {self.query}'
+        self._parts.insert(0, 'NOT ')
         return self
 
     def __call__(self, *args) -> Self:
-        self.query += f'({", ".join(map(lambda x: "`%s`" % x, args))})'
+        names = list(map(str, args))
+        for name in names:
+            if not _IDENTIFIER.fullmatch(name):
+                raise ValueError(f'{name!r} is not a valid identifier')
+        self._parts.append('(`' + '`, `'.join(names) + '`)')
         return self
 
     def __contains__(self, __value: Any) -> Self:
         if isinstance(__value, str):
-            self.query += f' LIKE "%{__value}%"'
+            self._parts.append(' LIKE %s')
+            self._params.append(f'%{__value}%')
         elif isinstance(__value, Iterable):
-            self.query += f' IN ({", ".join(map(str, __value))})'
+            self._parts.append(f' IN ({", ".join(map(self._operand, __value))})')
         return self
 
     def __iter__(self) -> Iterable[str]:
@@ -393,46 +759,63 @@ class _SelectQuery:
         return len(self.query.split())
 
     def from_(self, table: type["Model"]) -> Self:
-        self.query += f' FROM {table.__name__}'
+        self._parts.append(f' FROM {table.__name__}')
         return self
     
     def join(self, table: type["Model"]) -> Self:
-        self.query += f' INNER JOIN {table.__name__}'
+        self._parts.append(f' INNER JOIN {table.__name__}')
         return self
     
     def on(self, condition: Self) -> Self:
-        self.query += f' ON {condition}'
+        self._parts.append(f' ON {self._condition(condition)}')
         return self
 
+    @classmethod
+    def _compare_all(cls, values: dict[str, Any], op: str = '=') -> Self:
+        "Returns `key <op> %s AND ...` for every item of `values`, with the values bound."
+        query = cls()
+        query._parts.append(' AND '.join(f'{key} {op} %s' for key in values))
+        query._params.extend(values.values())
+        return query
+
+    def _condition(self, condition: Self | str) -> str:
+        if isinstance(condition, _SelectQuery):
+            self._params.extend(condition._params)
+            return str(condition)
+        return _escape_percent(str(condition))
+
     def where(self, condition: Self) -> Self:
-        self.query += f' WHERE {condition}'
+        self._parts.append(f' WHERE {self._condition(condition)}')
         return self
 
     def group_by(self, *args: "_FieldBase") -> Self:
-        self.query += f' GROUP BY {", ".join(map(str, args))}'
+        self._parts.append(f' GROUP BY {", ".join(map(str, args))}')
         return self
 
     def having(self, condition: Self) -> Self:
-        self.query += f' HAVING {condition}'
+        self._parts.append(f' HAVING {self._condition(condition)}')
         return self
     
     def order_by(self, field: "_FieldBase", descending: bool = None) -> Self:
-        self.query += f' ORDER BY {field}'
+        self._parts.append(f' ORDER BY {field}')
         if descending:
-            self.query += ' DESC'
+            self._parts.append(' DESC')
         return self
     
     def limit(self, limit: int) -> Self:
-        self.query += f' LIMIT {limit}'
+        self._parts.append(f' LIMIT {limit}')
         return self
 
     def offset(self, offset: int) -> Self:
-        self.query += f' OFFSET {offset}'
+        self._parts.append(f' OFFSET {offset}')
         return self
 
     def execute(self):
-        _sessions[0].execute(self.query + ';')
-        return _sessions[0].cursor
+        # Parameters are always passed, even when empty, so the driver %-formats the text and unescapes raw SQL's `%%`.
+        with _acquire() as sess:
+            cursor = sess.conn.cursor(_cursors.DictCursor)
+            sess.execute(''.join(self._parts) + ';', self._params, cursor=cursor)
+        return cursor
 
 
 def select(*args: Union[RawFormat, "_FieldBase"]) -> _SelectQuery:
@@ -443,33 +826,38 @@ def select(*args: Union[RawFormat, "_FieldBase"]) -> _SelectQuery:
             query += args[0].value
         else:
             for field in args:
-                if isinstance(field, _FieldBase):
-                    query += field.name + ", "
-                else:
+                if not isinstance(field, _FieldBase):
                     raise TypeError(f'{field} is not a field. Try using RawFormat.')
-            query.query = query.query[:-2]
+            query += ", ".join(field.name for field in args)
     else:
         query += '*'
     return query
 
 
+@functools.lru_cache(maxsize=None)
+def _definition_prefix(type_definition: str, auto_increment: bool, nullable: bool, pk: bool, has_default: bool) -> str:
+    "Returns the part of a column definition that doesn't depend on the default value."
+    parts = [type_definition]
+
+    if auto_increment:
+        parts.append("AUTO_INCREMENT")
+    if not nullable or pk:
+        parts.append("NOT NULL")
+    elif not has_default:
+        parts.append("DEFAULT NULL")
+    return ' '.join(parts)
+
+
 class _FieldBase:
-    def __init__(self, *, pk: bool, nullable: bool, default: Any, name: str) -> None:
+    def __init__(self, *, pk: bool, nullable: bool, default: Any, name: str, auto_increment: bool = False) -> None:
         self.name = name
+        self.auto_increment = auto_increment
+        self.definition = _definition_prefix(self.type.definition, auto_increment, nullable, pk, default is not None)
 
-        if nullable and not pk:
-            if default is None:
-                self.definition += "DEFAULT NULL "
-            elif isinstance(default, RawFormat):
-                self.definition += f'DEFAULT {default.value} '
-            else:
-                self.definition += f'DEFAULT {self.type.default_format(default)} '
-        else:
-            self.definition += "NOT NULL "
-            if isinstance(default, RawFormat):
-                self.definition += f'DEFAULT {default.value} '
-            elif default is not None:
-                self.definition += f'DEFAULT {self.type.default_format(default)} '
+        if isinstance(default, RawFormat):
+            self.definition += f' DEFAULT {default.value}'
+        elif default is not None:
+            self.definition += f' DEFAULT {self.type.default_format(default)}'
 
     def __str__(self) -> str:
         return self.name
@@ -535,19 +923,12 @@ class Field(_FieldBase):
         if transform is None:
             self.transform = type.to_python
         else:
-            self.transform = lambda x: x
+            self.transform = _identity
 
-        self.definition = type.definition + ' '
+        super().__init__(pk=pk, nullable=nullable, default=default, name=name, auto_increment=auto_increament)
 
-        if auto_increament:
-            self.definition += " AUTO_INCREMENT"
-
-        super().__init__(pk=pk, nullable=nullable, default=default, name=name)
-
-        for arg in raw_args:
-            self.definition += arg + ' '
-
-        self.definition = self.definition.removesuffix(' ')
+        if raw_args:
+            self.definition = ' '.join((self.definition, *raw_args))
         self.set_value = None
 
     def setter(self, func: Callable[[Any], None]) -> None:
@@ -588,7 +969,6 @@ class ForeignKey(_FieldBase):
         "`str`: The name of the attribute that is referenced."
 
         self.type = self.referenced_field.type
-        self.definition = self.referenced_field.type.definition + ' '
 
         super().__init__(pk=pk, nullable=nullable, default=default, name=name)
 
@@ -603,41 +983,250 @@ class ForeignKey(_FieldBase):
         self.primary = pk
         self.unique = unique
         self.only_one = only_one
+        self.attr: str = None
+        "`str`: The name of the attribute that holds this foreign key."
 
+    def __set_name__(self, owner: type["Model"], name: str) -> None:
+        self.attr = name
+
+    def __get__(self, obj: "Model | None", owner: type["Model"] = None) -> Any:
+        # The referenced object is loaded on first access, then stored on the instance, which shadows this descriptor.
+        if obj is None:
+            return self
+        return obj._match_foreign_key(self.attr)
 
-class _Undefiend: ...
 
 _T = TypeVar("_T", bound="Model")
 
 
 class _Records(Generic[_T]):
+    _tpl_cache: OrderedDict[tuple, str] = OrderedDict()
+    "OrderedDict[`tuple`, `str`]: Built SQL keyed by the records class, the model, the builder and its arguments."
+    _tpl_cache_size: int = 1024
+    "`int`: The number of templates kept. The least recently used one is dropped first."
+
     def __init__(self, model: type["Model"]) -> None:
         self.model = model
+        self._prefetch: tuple[str, ...] = ()
 
     def __call__(self, **kwargs) -> _T:
         "Returns a new object created with the given kwargs."
-        query = f'INSERT INTO {self.model.__name__} ('
-        values = "VALUES ("
+        return self._written(kwargs, self._insert([kwargs]))
+
+    def _written(self, kwargs: dict[str, Any], lastrowid: int | None = None) -> _T:
+        """Returns the object for a row that was just written from `kwargs`.
+        The values in `kwargs` are Python values already, so they are set as they are instead of being converted as a row.
+        Fields that were left out take their defaults (or `None` for SQL defaults), since the table does have those columns.
+        An AUTO_INCREMENT primary key that was left out or `None` is taken from `lastrowid`."""
+        data = {}
+        values = {}
+        for attr, name, field in self.model._field_names:
+            value = kwargs.get(attr)
+            if field.primary and field.auto_increment and value is None and lastrowid:
+                value = lastrowid
+            elif attr not in kwargs:
+                if not field.primary:
+                    data[name] = None if isinstance(field.default, RawFormat) else field.default
+                continue
 
-        for key, value in kwargs.items():
-            query += f'{key}, '
+            if not isinstance(field, ForeignKey):
+                values[attr] = value
+                if field.primary:
+                    data[name] = value
+            elif isinstance(value, Model):
+                values[attr] = value
+                data[name] = getattr(value, field.referenced_attr_name)
+            else:
+                # Only the column value is known, so the referenced object is loaded on access as for a fetched row.
+                data[name] = value
+        return self.model(data, **values)
+
+    def _auto_increment_key(self) -> "Field | None":
+        "Returns the primary key if it's a single AUTO_INCREMENT column."
+        primary_keys = self.model.primary_keys
+        if len(primary_keys) == 1 and primary_keys[0].auto_increment:
+            return primary_keys[0]
+        return None
+
+    def _template(self, build: Callable[..., str], *args: Any) -> str:
+        "Returns the SQL made by `build(*args)`, which is only called the first time for this model."
+        key = (type(self), self.model, build.__name__, *args)
+        cache = self._tpl_cache
+        if (query := cache.get(key)) is not None:
+            try:
+                cache.move_to_end(key)
+            except KeyError:
+                # Evicted by another thread in the meantime.
+                pass
+            return query
+
+        if len(cache) >= self._tpl_cache_size:
+            # RawFormat SQL is part of some keys, so the number of templates isn't bounded by the models.
+            try:
+                cache.popitem(last=False)
+            except KeyError:
+                pass
+        query = cache[key] = build(*args)
+        return query
+
+    def _fields(self, keys: Iterable[str]) -> list["Field | ForeignKey"]:
+        fields = []
+        for key in keys:
             if (field := self.model.fields.get(key)) is None:
                 raise ValueError(f'{key} is not a field')
-            values += f'{field.type.to_sql(value)}, '
-        query = query[:-2] + ") " + values[:-2] + ");"
-        _sessions[0].execute(query)
-        _sessions[0].conn.commit()
-        return self.model(_sessions[0], kwargs)
+            fields.append(field)
+        return fields
+
+    def _insert_into(self, fields: list["Field | ForeignKey"]) -> str:
+        columns = ", ".join(field.name for field in fields)
+        return f'INSERT INTO {self.model.__name__} ({columns}) VALUES ({", ".join(["%s"] * len(fields))})'
+
+    def _build_insert(self, keys: tuple[str, ...], update: bool) -> str:
+        fields = self._fields(keys)
+
+        if update:
+            pk = self._auto_increment_key()
+            assignments = [f'{field.name} = VALUES({field.name})' for field in fields if field is not pk]
+            if pk is not None:
+                # Makes the id of an updated row the insert id too, so it can be read from `lastrowid`.
+                # A key that is bound as `NULL` leaves the existing one, as it does when it's left out.
+                value = f'COALESCE(VALUES({pk.name}), {pk.name})' if pk in fields else pk.name
+                assignments.append(f'{pk.name} = LAST_INSERT_ID({value})')
+            assignments = ", ".join(assignments)
+            return f'{self._insert_into(fields)} ON DUPLICATE KEY UPDATE {assignments};'
+        return f'{self._insert_into(fields)};'
+
+    def _build_insert_missing(self, keys: tuple[str, ...]) -> str:
+        "Inserts the row unless a key is taken, in which case no row is affected."
+        pk = self.model.primary_keys[0].name
+        return f'{self._insert_into(self._fields(keys))} ON DUPLICATE KEY UPDATE {pk} = {pk};'
+
+    def _build_update(self, keys: tuple[str, ...], raw: tuple[str | None, ...]) -> str:
+        "`raw` holds the SQL of each `RawFormat` value, or `None` for the values that are bound."
+        assignments = [
+            f'{field.name} = %s' if sql is None else f'{field.name} = {sql.replace("%", "%%")}'
+            for field, sql in zip(self._fields(keys), raw)
+        ]
+        return f'UPDATE {self.model.__name__} SET {", ".join(assignments)}{self._where_suffix()};'
+
+    def _where_suffix(self) -> str:
+        "The WHERE clause of the UPDATE built by `_build_update`. Updates every row by default."
+        return ''
+
+    def _update_query(self, kwargs: dict[str, Any]) -> tuple[str, list[Any]]:
+        "Returns the cached UPDATE for `kwargs` and the values to bind. Raw SQL is part of the text, so it is in the cache key too."
+        raw = tuple(value.value if isinstance(value, RawFormat) else None for value in kwargs.values())
+        query = self._template(self._build_update, tuple(kwargs), raw)
+        # The list is passed even when it's empty, so the driver always unescapes `%%`.
+        params = list(self._convert({key: value for key, value in kwargs.items() if not isinstance(value, RawFormat)}).values())
+        return query, params
+
+    def _build_select(self, keys: tuple[str, ...]) -> str:
+        query = self.model._sql_select_all
+
+        if keys:
+            query += ' WHERE ' + ' AND '.join(f'{key} = %s' for key in keys)
+        return query + ';'
+
+    def _insert(self, rows: list[dict[str, Any]], update: bool = False) -> int:
+        "Returns the AUTO_INCREMENT id of the first row written."
+        keys = tuple(rows[0])
+        query = self._template(self._build_insert, keys, update)
+        model_fields = self.model.fields
+        converters = [(key, model_fields[key].type.to_param) for key in keys]
+
+        # `None` is bound as NULL as it is, since not every `to_param` accepts it.
+        params = [tuple(None if (value := row[key]) is None else to_param(value) for key, to_param in converters) for row in rows]
+        with _acquire() as sess:
+            sess.executemany(query, params)
+            return sess.cursor.lastrowid
+
+    def bulk_create(self, rows: Iterable[dict[str, Any]]) -> None:
+        "Inserts every row in a single round-trip. All rows must have the same keys."
+        if rows := list(rows):
+            self._insert(rows)
+
+    def bulk_create_or_update(self, rows: Iterable[dict[str, Any]]) -> None:
+        "Same as `bulk_create`, but rows that hit an existing key are updated instead."
+        if rows := list(rows):
+            self._insert(rows, update=True)
+
+    def update_many(self, rows: Iterable[dict[str, Any]]) -> None:
+        """Updates many rows in a single query. Each row has the primary key and the fields to set, with the same keys in every row.
+        Unlike `bulk_create_or_update`, rows that don't exist are not inserted."""
+        if not (rows := list(rows)):
+            return
+
+        keys = tuple(rows[0])
+        fields = self._fields(keys)
+        table = self.model.__name__
+        pk_names = {field.name for field in self.model.primary_keys}
+        names = [field.name for field in fields]
+
+        if not pk_names <= set(names):
+            raise ValueError("Every row must have the primary key")
+        if pk_names >= set(names):
+            raise ValueError("There is no field to update")
+
+        # The rows are joined as a derived table, whose column names come from the first SELECT.
+        first = "SELECT " + ", ".join(f'%s AS {name}' for name in names)
+        values = " UNION ALL ".join([first] + [f'SELECT {", ".join(["%s"] * len(names))}'] * (len(rows) - 1))
+        on = " AND ".join(f'{table}.{name} = v.{name}' for name in names if name in pk_names)
+        assignments = ", ".join(f'{table}.{name} = v.{name}' for name in names if name not in pk_names)
+
+        converters = [(key, field.type.to_param) for key, field in zip(keys, fields)]
+        params = [to_param(row[key]) for row in rows for key, to_param in converters]
+        with _acquire() as sess:
+            sess.execute(f'UPDATE {table} JOIN ({values}) AS v ON {on} SET {assignments};', params)
+
+    def delete_many(self, pks: Iterable[Any]) -> None:
+        "Deletes the rows with the given primary keys in a single query. With a composite primary key, each key is a tuple."
+        if not (pks := list(pks)):
+            return
+
+        primary_keys = self.model.primary_keys
+        if len(primary_keys) == 1:
+            to_param = primary_keys[0].type.to_param
+            params = [to_param(pk) for pk in pks]
+            condition = f'{primary_keys[0].name} IN ({", ".join(["%s"] * len(pks))})'
+        else:
+            row = f'({", ".join(["%s"] * len(primary_keys))})'
+            params = [field.type.to_param(value) for pk in pks for field, value in zip(primary_keys, pk)]
+            condition = f'({", ".join(field.name for field in primary_keys)}) IN ({", ".join([row] * len(pks))})'
 
-    def _select_data(self, query: str | None = None, **kwargs) -> None:
-        if query is None:
-            query = f'SELECT * FROM {self.model.__name__} WHERE '
+        with _acquire() as sess:
+            sess.execute(f'DELETE FROM {self.model.__name__} WHERE {condition};', params)
 
-        for key, value in kwargs.items():
-            query += f'{key} = \'{value}\' AND '
+    def _from_query(self) -> str:
+        return f'SELECT * FROM {self.model.__name__}'
 
-        query = query[:-5] + ";"
-        _sessions[0].execute(query)
+    def _convert(self, kwargs: dict[str, Any]) -> dict[str, Any]:
+        "Converts each value with `to_param` of the field of the same name, if there is one."
+        fields = self.model.fields
+        converted = {}
+        for key, value in kwargs.items():
+            field = fields.get(key)
+            converted[key] = value if field is None else field.type.to_param(value)
+        return converted
+
+    def _select_query(self, **kwargs) -> tuple[str, list[Any]]:
+        return self._template(self._build_select, tuple(kwargs)), list(self._convert(kwargs).values())
+
+    def _iter(self, query: str, params: list[Any] | None = None, batch_size: int | None = None) -> Iterator[_T]:
+        if _current_session.get() is not None:
+            # Queries made inside the loop (including lazy foreign keys) would reuse the checked out session
+            # while its unbuffered result is being read, so the rows are fetched up front instead.
+            with _acquire() as sess:
+                sess.execute(query, params)
+                rows = sess.cursor.fetchall()
+
+            for data in rows:
+                yield self.model(data)
+        else:
+            # No session is checked out, and this one is not shared, so queries made while iterating go through another one.
+            with _acquire(share=False) as sess:
+                for data in sess.stream(query, params, batch_size):
+                    yield self.model(data)
 
     @overload
     def get(self, **kwargs) -> _T | None:
@@ -648,8 +1237,9 @@ class _Records(Generic[_T]):
         ...
 
     def get(self, *args, **kwargs) -> _T | None:
-        self._select_data(**kwargs)
-        result = _sessions[0].cursor.fetchone()
+        with _acquire() as sess:
+            sess.execute(*self._select_query(**kwargs))
+            result = sess.cursor.fetchone()
 
         if result is None:
             return None
@@ -667,9 +1257,12 @@ class _Records(Generic[_T]):
         else:
             return self.model(result)
 
+    def iter_filter(self, **kwargs) -> Iterator[_T]:
+        "Same as `filter`, but yields the objects while the rows are streamed from the server."
+        return self._iter(*self._select_query(**kwargs))
+
     def filter(self, **kwargs) -> list[_T]:
-        self._select_data(**kwargs)
-        return [self.model(data) for data in _sessions[0].cursor.fetchall()]
+        return self._prefetch_related(list(self.iter_filter(**kwargs)))
 
     def attach(self, model: "Model") -> list[_T]:
         for fk in self.model.foreign_keys:
@@ -689,105 +1282,123 @@ class _Records(Generic[_T]):
     def exclude(self, **kwargs) -> list[_T]:
         query = select().from_(self.model)
 
-        for key, value in kwargs.items():
-            query += f' {key} != \'{value}\' AND'
-
-        query.query = query.query[:-5]
+        if kwargs:
+            query.where(_SelectQuery._compare_all(self._convert(kwargs), '!='))
 
         return [self.model(data) for data in query.execute().fetchall()]
 
+    def iter_all(self, batch_size: int | None = None) -> Iterator[_T]:
+        "Same as `all`, but yields the objects while the rows are streamed from the server."
+        return self._iter(self.model._sql_select_all + ';', batch_size=batch_size)
+
     def all(self) -> list[_T]:
-        _sessions[0].execute(f'SELECT * FROM {self.model.__name__};')
-        return [self.model(_sessions[0], data) for data in _sessions[0].cursor.fetchall()]
+        return self._prefetch_related(list(self.iter_all()))
+
+    def as_dataframe(self, **kwargs) -> "pandas.DataFrame":
+        "Returns the matching rows as a `pandas.DataFrame` whose columns are cast at once instead of row by row. Requires pandas."
+        import pandas
+
+        with _acquire() as sess:
+            sess.execute(*self._select_query(**kwargs))
+            rows = sess.cursor.fetchall()
+
+        df = pandas.DataFrame.from_records(rows, columns=[field.name for field in self.model.fields.values()])
+        for field in self.model.fields.values():
+            if not isinstance(field, ForeignKey):
+                df[field.name] = _cast_column(df[field.name], field.type)
+        return df
+
+    def to_models(self, df: "pandas.DataFrame") -> Iterator[_T]:
+        "Yields a model object for each row of a data frame returned by `as_dataframe`."
+        for data in df.astype(object).where(df.notna(), None).to_dict("records"):
+            yield self.model(data)
+
+    def prefetch(self, *attrs: str) -> Self:
+        "Returns records whose `all` and `filter` load the given foreign keys of every object with a single query per key."
+        for attr in attrs:
+            if not isinstance(self.model.fields.get(attr), ForeignKey):
+                raise ValueError(f'{attr} is not a foreign key')
+
+        records = copy.copy(self)
+        records._prefetch = attrs
+        return records
+
+    def _prefetch_related(self, objs: list[_T]) -> list[_T]:
+        for attr in self._prefetch:
+            field: ForeignKey = self.model.fields[attr]
+            pending = [obj for obj in objs if attr not in obj.__dict__]
+            keys = list({obj.foreign_data[attr] for obj in pending})
+
+            if not keys:
+                continue
+
+            column = field.referenced_field.name
+            with _acquire() as sess:
+                sess.execute(f'SELECT * FROM {field.table.__name__} WHERE {column} IN ({", ".join(["%s"] * len(keys))});', keys)
+                rows = sess.cursor.fetchall()
+
+            related: dict[Any, list[dict[str, Any]]] = {}
+            for row in rows:
+                related.setdefault(row[column], []).append(row)
+
+            get_related = related.get
+            for obj in pending:
+                obj._set_foreign_key(attr, get_related(obj.foreign_data[attr], []))
 
-    def count(self, condition: _SelectQuery = _SelectQuery(), **kwargs) -> int:
+        return objs
+
+    def count(self, condition: _SelectQuery | None = None, **kwargs) -> int:
         query = select(RawFormat("COUNT(*)")).from_(self.model)
 
         if kwargs:
-            for key, value in kwargs.items():
-                condition += f'{key} = {value} AND '
-
-            query.query = query.query[:-5]
+            matches = _SelectQuery._compare_all(self._convert(kwargs))
+            condition = matches if condition is None else condition & matches
 
-        query.where(condition)
+        if condition is not None:
+            query.where(condition)
 
         return query.execute().fetchone()['COUNT(*)']
 
     def update(self, **kwargs) -> None:
-        query = f'UPDATE {self.model.__name__} SET '
-
-        for key, value in kwargs.items():
-            if (field := self.model.fields.get(key)) is None:
-                raise ValueError(f'{key} is not a field')
-            query += f'{key} = {field.type.to_sql(value)}, '
-        query = query[:-2] + ";"
-        _sessions[0].execute(query)
-        _sessions[0].conn.commit()
+        query, params = self._update_query(kwargs)
+        with _acquire() as sess:
+            sess.execute(query, params)
 
     def get_or_create(self, **kwargs) -> _T:
+        names = {field.name for attr, field in self.model.fields.items() if attr in kwargs}
+        if not (
+            all(field.name in names for field in self.model.primary_keys)
+            or any(field.name in names for field in self.model.unique_keys)
+        ):
+            # Nothing would stop a duplicate row, so it has to be looked up first.
+            if (obj := self.get(**kwargs)) is None:
+                obj = self(**kwargs)
+            return obj
+
+        with _acquire() as sess:
+            sess.execute(self._template(self._build_insert_missing, tuple(kwargs)), list(self._convert(kwargs).values()))
+            inserted = sess.cursor.rowcount == 1
+            lastrowid = sess.cursor.lastrowid
+
+        if inserted:
+            return self._written(kwargs, lastrowid)
         if (obj := self.get(**kwargs)) is None:
+            # The key is taken by a row with other values; inserting again raises the same error as before.
             obj = self(**kwargs)
         return obj
 
     def create_or_update(self, **kwargs) -> _T:
-        query = f'INSERT INTO {self.model.__name__} ('
-        values = "VALUES ("
-
-        for key, value in kwargs.items():
-            query += f'{key}, '
-            if (field := self.model.fields.get(key)) is None:
-                raise ValueError(f'{key} is not a field')
-            values += f'{field.type.to_sql(value)}, '
-        query = query[:-2] + ") " + values[:-2] + ") ON DUPLICATE KEY UPDATE "
-
-        for key, value in kwargs.items():
-            if (field := self.model.fields.get(key)) is None:
-                raise ValueError(f'{key} is not a field')
-            query += f'{key} = {field.type.to_sql(value)}, '
-        query = query[:-2] + ";"
-        _sessions[0].execute(query)
-        _sessions[0].conn.commit()
-        return self.model(_sessions[0], kwargs)
+        return self._written(kwargs, self._insert([kwargs], update=True))
 
 
 class _JoinedRecords(_Records, Generic[_T]):
-    def get(self, *args, **kwargs) -> _T | None:
-        super_model: type[Model] = self.model.__base__
-
-        query = f'SELECT * FROM {self.model.__name__}'
-        query += f'\nINNER JOIN {super_model.__name__} ON '
-
-        for fk in self.model.foreign_keys_for_join:
-            query += f'{self.model.__name__}.{fk.name} = {super_model.__name__}.{fk.referenced_attr_name} AND '
-        query = query[:-5]
-
-        query += f'\nWHERE '
-
-        self._select_data(query, **kwargs)
-        result = _sessions[0].cursor.fetchone()
-        if result is None:
-            return None
-
-        return self.model(result)
-    
-    def filter(self, **kwargs) -> list[_T]:
+    def _from_query(self) -> str:
         super_model: type[Model] = self.model.__base__
-
-        query = f'SELECT * FROM {self.model.__name__}'
-        query += f'\nINNER JOIN {super_model.__name__} ON '
-
-        for fk in self.model.foreign_keys_for_join:
-            query += f'{self.model.__name__}.{fk.name} = {super_model.__name__}.{fk.referenced_attr_name} AND '
-
-        query = query[:-5]
-        query += f'\nWHERE '
-        self._select_data(query, **kwargs)
-
-        return [self.model(data) for data in _sessions[0].cursor.fetchall()]
-    
-    def all(self) -> list[_T]:
-        _sessions[0].execute(f'SELECT * FROM {self.model.__name__} {self.join};')
-        return [self.model(_sessions[0], data) for data in _sessions[0].cursor.fetchall()]
+        on = ' AND '.join(
+            f'{self.model.__name__}.{fk.name} = {super_model.__name__}.{fk.referenced_attr_name}'
+            for fk in self.model.foreign_keys_for_join
+        )
+        return f'SELECT * FROM {self.model.__name__}\nINNER JOIN {super_model.__name__} ON {on}'
 
 
 class MatchingError(Exception):
@@ -806,19 +1417,27 @@ class Model:
     "`str`: The name of the attribute that matchs the primary key."
     objects: _Records[Self] | _JoinedRecords[Self]
     "`_Records`: The objects of this model."
+    _field_names: tuple[tuple[str, str, "Field | ForeignKey"], ...]
+    "Tuple[Tuple[`str`, `str`, `Field` | `ForeignKey`]]: The attribute name, the column name and the field of every field."
+    _sql_select_all: str
+    "`str`: `SELECT * FROM` this model, with the join to the parent model if there is one. Built once per class."
     foreign_keys_for_join: list[ForeignKey]
     "List[`ForeignKey`]: The foreign keys that are used for joining tables."
 
-    def __init__(self, data: dict[str, Any] = {}, match: bool = True, **kwargs) -> None:
+    def __init__(self, data: dict[str, Any] = {}, /, match: bool = True, **kwargs) -> None:
         self.matched: bool = False
         self.primary_data: dict[str, Any] = {}
+        self.foreign_data: dict[str, Any] = {}
+        "Dict[`str`, `Any`]: The raw values of the foreign keys, by attribute name."
         self.object: _Record = _Record(self)
 
-        if match:
-            self.match_attr(data, **kwargs)
-        else:
+        if not match:
             for attr in self.fields:
                 setattr(self, attr, None)
+        elif kwargs:
+            self.match_attr(data, **kwargs)
+        else:
+            self._bind(data)
 
         self.init()
 
@@ -839,11 +1458,12 @@ class Model:
         else:
             cls.objects = _Records(cls)
 
-        if model and cls.__name__ not in [c.__name__ for c in models]:
+        if model and cls.__name__ not in _model_names:
             models.append(cls)
+            _model_names.add(cls.__name__)
 
-            for attr in dir(cls):
-                if isinstance(field := getattr(cls, attr), (Field, ForeignKey)):
+            for attr, field in cls.__dict__.items():
+                if isinstance(field, (Field, ForeignKey)):
                     field.name = field.name or attr
 
                     if isinstance(field, ForeignKey):
@@ -863,7 +1483,7 @@ class Model:
                     if field.unique:
                         cls.unique_keys.append(field)
 
-                    setattr(cls, attr, field)
+            cls._bind = _build_binder(cls)
         else:
             cls.primary_keys = super_cls.primary_keys
             cls.fields = super_cls.fields
@@ -871,47 +1491,66 @@ class Model:
             cls.unique_keys = super_cls.unique_keys
             cls.primary_attr = super_cls.primary_attr
 
+        cls._field_names = tuple((attr, field.name or attr, field) for attr, field in cls.fields.items())
+        cls._sql_select_all = cls.objects._from_query()
+
     def __setattr__(self, __name: str, __value: Any) -> None:
         if isinstance(__value, RawFormat):
-            self.object.update(**{__name: __value.value})
+            self.object.update(**{__name: __value})
             super().__setattr__(__name, self.object.get_value(__name))
         else:
             super().__setattr__(__name, __value)
 
-    def match_attr(self, data: dict[str, Any], **kwargs) -> Self:
+    def match_attr(self, data: dict[str, Any], /, **kwargs) -> Self:
+        "Sets the fields from `data`, except the ones given in `kwargs`, which are set as they are."
         cls = self.__class__
-        for attr in cls.fields:
-            if attr in kwargs:
-                setattr(self, attr, kwargs[attr])
-                continue
-            field = cls.fields[attr]
-            name = cls.fields[attr].name or attr
+        for attr, name, field in cls._field_names:
             if field.primary:
-                try:
+                # Kept even when the attribute is given in `kwargs`, since `object.update` and `delete` need the row's key.
+                if name in data:
                     self.primary_data[attr] = data[name]
-                except KeyError:
+                elif attr not in kwargs:
                     raise MatchingError(f'{name} is not in `{cls.__name__}`.')
+            if attr in kwargs:
+                setattr(self, attr, kwargs[attr])
+                continue
             if isinstance(field, Field):
-                value = data.get(name, _Undefiend)
-                if value is _Undefiend:
-                    field = self.undefined_field(field)
-                    value = field.default
-                field = field.transform(value)
+                value = data[name] if name in data else self._missing_value(attr)
+                setattr(self, attr, None if value is None else field.transform(value))
             elif isinstance(field, ForeignKey):
-                _sessions[0].execute(f'SELECT * FROM {field.table.__name__} WHERE {field.referenced_field.name} = \'{data[name]}\'')
-                arr = _sessions[0].cursor.fetchall()
-                if field.only_one:
-                    if arr:
-                        field = field.table(arr[0], **{field.referenced_attr_name: self})
-                    else:
-                        field = None
-                else:
-                    field = [field.table(d, **{field.referenced_attr_name: self}) for d in arr]
-
-            setattr(self, attr, field)
+                self.foreign_data[attr] = data[name]
 
         return self
 
+    def _missing_value(self, attr: str) -> Any:
+        """Called when a row has no column for `attr`. Returns the value to use instead.
+        The column is recorded to be added by `sync_schema`."""
+        key = (self.__class__.__name__, attr)
+        if key not in _missing_columns:
+            _missing_columns.add(key)
+            _log.warning("Column %s.%s is missing; call Model.sync_schema() to add it", *key)
+        return self.fields[attr].default
+
+    def _match_foreign_key(self, attr: str) -> Any:
+        "Loads and sets the object(s) that the foreign key `attr` refers to."
+        field: ForeignKey = self.fields[attr]
+        with _acquire() as sess:
+            sess.execute(f'SELECT * FROM {field.table.__name__} WHERE {field.referenced_field.name} = %s', (self.foreign_data[attr],))
+            arr = sess.cursor.fetchall()
+        return self._set_foreign_key(attr, arr)
+
+    def _set_foreign_key(self, attr: str, rows: list[dict[str, Any]]) -> Any:
+        field: ForeignKey = self.fields[attr]
+
+        if not field.only_one:
+            value = [field.table(d, **{field.referenced_attr_name: self}) for d in rows]
+        elif rows:
+            value = field.table(rows[0], **{field.referenced_attr_name: self})
+        else:
+            value = None
+        setattr(self, attr, value)
+        return value
+
     def init(self) -> None:
         "Called after the object is created."
         pass
@@ -920,14 +1559,48 @@ class Model:
         kwargs = {}
 
         for attr_name, field in self.fields.items():
-            kwargs[field.name or attr_name] = field.type.to_sql(getattr(self, attr_name))
+            if not isinstance(field, ForeignKey):
+                kwargs[attr_name] = getattr(self, attr_name)
+            elif isinstance(value := self.__dict__.get(attr_name), Model):
+                kwargs[attr_name] = getattr(value, field.referenced_attr_name)
+            else:
+                # Not loaded (or a list of referencing objects), so the stored column value is saved as is.
+                kwargs[attr_name] = self.foreign_data.get(attr_name)
+
+        obj = self.objects.create_or_update(**kwargs)
+        if self.primary_attr is not None and getattr(self, self.primary_attr) is None:
+            # An AUTO_INCREMENT key was generated by the insert, so this object can be updated or deleted afterwards.
+            setattr(self, self.primary_attr, getattr(obj, self.primary_attr))
+            self.primary_data.update(obj.primary_data)
+        return obj
 
-        return self.objects.create_or_update(**kwargs)
+    @staticmethod
+    def sync_schema() -> None:
+        "Adds the columns of every model that its table doesn't have yet, with a single ALTER TABLE per table."
+        with _acquire() as sess:
+            sess.execute("SELECT TABLE_NAME, COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = DATABASE();")
+            existing = {(row["TABLE_NAME"], row["COLUMN_NAME"]) for row in sess.cursor.fetchall()}
+            tables = {table for table, _ in existing}
+
+            for model in models:
+                if model.__name__ not in tables:
+                    continue
+                # Foreign keys also need a constraint, which is left to `migrate`.
+                # Only the model's own fields: a joined model's `fields` also has the columns of its parent's table.
+                columns = [
+                    f'ADD {field.name} {field.definition}' for field in vars(model).values()
+                    if isinstance(field, Field) and (model.__name__, field.name) not in existing
+                ]
+                if columns:
+                    sess.execute(f'ALTER TABLE {model.__name__} {", ".join(columns)};')
+                    _schema_cache.pop(model.__name__, None)
+        _missing_columns.clear()
 
     def undefined_field(self, field: Field):
         query = f'ALTER TABLE {self.__class__.__name__} ADD {field.name} {field.definition};'
-        _sessions[0].execute(query)
-        _sessions[0].conn.commit()
+        with _acquire() as sess:
+            sess.execute(query)
+        _schema_cache.pop(self.__class__.__name__, None)
         return field
 
 
@@ -940,71 +1613,94 @@ class _Record(_Records):
         if isinstance(field, Field):
             field = field.name
 
-        query = select(field).from_(self.obj.__class__)
+        query = select(RawFormat(str(field))).from_(self.obj.__class__)
 
-        if where:
-            query += f' {where}'
-        else:
-            for key, value in self.obj.primary_data.items():
-                query += f'{key} = {value} AND '
+        if where is None:
+            where = _SelectQuery._compare_all(self.obj.primary_data)
+        query.where(where)
 
         return query.execute().fetchone()[str(field)]
 
-    def update(self, **kwargs) -> _T:
-        query = f'UPDATE {self.obj.__name__} SET '
+    def _where_suffix(self) -> str:
+        return ' WHERE ' + ' AND '.join(f'{field.name} = %s' for field in self.model.primary_keys)
 
-        for key, value in kwargs.items():
-            if (field := self.obj.fields.get(key)) is None:
-                raise ValueError(f'{key} is not a field')
-            if isinstance(value, RawFormat):
-                query += f'{key} = {value.value}, '
-            else:
-                query += f'{key} = {field.type.to_sql(value)}, '
-        query = query[:-2] + " WHERE "
-
-        for key, value in self.obj.primary_data.items():
-            query += f'{key} = {value} AND '
-        query = query[:-5] + ";"
-        _sessions[0].execute(query)
-        _sessions[0].conn.commit()
+    def _primary_params(self) -> list[Any]:
+        "Returns the primary key values of the object, in the order of `model.primary_keys`."
+        try:
+            return [self.obj.primary_data[attr] for attr, _, field in self.model._field_names if field.primary]
+        except KeyError as e:
+            raise RuntimeError(f'{self.model.__name__} object has no value for the primary key {e.args[0]}')
+
+    def _build_delete(self) -> str:
+        return f'DELETE FROM {self.model.__name__}{self._where_suffix()};'
+
+    def update(self, **kwargs) -> _T:
+        query, params = self._update_query(kwargs)
+        params.extend(self._primary_params())
+        with _acquire() as sess:
+            sess.execute(query, params)
         return self.obj
     
     def delete(self) -> None:
-        query = f'DELETE FROM {self.obj.__class__.__name__} WHERE '
+        query = self._template(self._build_delete)
+        with _acquire() as sess:
+            sess.execute(query, self._primary_params())
+
+
+def _build_binder(cls: type[Model]) -> Callable[[Model, dict[str, Any]], None]:
+    """Generates the function that sets every field of a new `cls` object from a row.
+    Columns are read with straight-line code, missing columns are handed to `Model._missing_value`,
+    and foreign keys only keep their raw value until they are accessed."""
+    namespace: dict[str, Any] = {"MatchingError": MatchingError}
+    lines = ["def _bind(self, data):", "    attrs = self.__dict__"]
+
+    for i, (attr, field) in enumerate(cls.fields.items()):
+        name = field.name or attr
+        if field.primary:
+            lines.append(f"    if {name!r} not in data: raise MatchingError({f'{name} is not in `{cls.__name__}`.'!r})")
+            lines.append(f"    self.primary_data[{attr!r}] = data[{name!r}]")
+        if isinstance(field, ForeignKey):
+            lines.append(f"    self.foreign_data[{attr!r}] = data[{name!r}]")
+        else:
+            namespace[f"_transform_{i}"] = field.transform
+            lines.append(f"    value = data[{name!r}] if {name!r} in data else self._missing_value({attr!r})")
+            lines.append(f"    attrs[{attr!r}] = None if value is None else _transform_{i}(value)")
 
-        for key, value in self.obj.primary_data.items():
-            query += f'{key} = {value} AND '
-        query = query[:-5] + ";"
-        _sessions[0].execute(query)
-        _sessions[0].conn.commit()
+    exec(compile("\n".join(lines), f"<{cls.__name__}-bind>", "exec"), namespace)
+    return namespace["_bind"]
 
 
 models: list[type[Model]] = []
 "List[Type[`Model`]]: List of all tables in the database."
+_model_names: set[str] = set()
+_missing_columns: set[tuple[str, str]] = set()
+"Set[Tuple[`str`, `str`]]: The model and attribute names of the columns that rows were read without."
 
 
 def _create_create_table_query(table: type[Model]) -> str:
-    query = f'CREATE TABLE IF NOT EXISTS `{table.__name__}` (\n'
-
-    for attr_name in table.__annotations__:
-        field = getattr(table, attr_name, None)
-
-        if isinstance(field, (Field, ForeignKey)):
-            name = field.name or attr_name
-            definition = field.definition
-        else:
-            continue
-        query += f'\t{name} {definition},\n'
-    query += f'\tPRIMARY KEY({", ".join(map(str, table.primary_keys))}),\n'
-    query = query[:-2] + "\n);"
-    return query
+    lines = [f'CREATE TABLE IF NOT EXISTS `{table.__name__}` (']
+    lines.extend(
+        f'\t{field.name or attr_name} {field.definition},'
+        for attr_name in table.__annotations__
+        if isinstance(field := getattr(table, attr_name, None), (Field, ForeignKey))
+    )
+    lines.append(f'\tPRIMARY KEY({", ".join(map(str, table.primary_keys))})')
+    lines.append(');')
+    return '\n'.join(lines)
 
 
 def create_tables() -> None:
-    for table in models:
-        query = _create_create_table_query(table)
-        _sessions[0].execute(query)
-        _sessions[0].conn.commit()
+    if not (queries := [_create_create_table_query(table) for table in models]):
+        return
+    with _acquire() as sess:
+        if sess.multi_statements:
+            # A failing statement raises from nextset(), so every result has to be read.
+            sess.execute('\n'.join(queries))
+            while sess.cursor.nextset():
+                pass
+        else:
+            for query in queries:
+                sess.execute(query)
 
 
 def _check_query(query: str | Iterable[str]) -> None:
@@ -1013,9 +1709,10 @@ def _check_query(query: str | Iterable[str]) -> None:
     print(*query, sep='\n')
     rep = input("1). Execute\n2). Modify query\n3). Abort\n")
     if rep == '1':
-        for q in query:
-            _sessions[0].execute(q)
-        _sessions[0].conn.commit()
+        with _acquire() as sess:
+            for q in query:
+                sess.execute(q)
+        _schema_cache.clear()
     elif rep == '2':
         query = input("Query: ")
         _check_query(query)
@@ -1023,146 +1720,273 @@ def _check_query(query: str | Iterable[str]) -> None:
         print("Aborted.")
         return
 
-# TO DO: Add support for foreign keys
-def migrate() -> None:
-    try:
-        for model in models:
-            _sessions[0].execute(f'SHOW CREATE TABLE {model.__name__};')
-            table_creation_query: str = _sessions[0].cursor.fetchone()['Create Table']
-            field_names: list[str] = [''] * len(model.fields)
-            different_attrs: dict[str, str] = {}
-            different_columns: dict[str, str] = {}
-            foreign_keys: dict[str, str] = {}
-            definitions: dict[str, str] = {}
-            other_definitions: list[str] = []
-    
-            for c_def in table_creation_query.split('\n')[1:-1]:
-                if (_c_arr := c_def.strip().split())[0].startswith('`'):
-                    definitions[_c_arr[0].strip('`')] = ' '.join(_c_arr[1:]).removesuffix(',')
-                else:
-                    other_definitions.append(' '.join(_c_arr).removesuffix(','))
-
-            i = 0
-            for field in model.fields.values():
-                field_names[i] = field.name
-                if isinstance(field, ForeignKey):
-                    arr = field.definition.split(",\n\t")
-                    fd = arr[0]
-                    kd = arr[1]
-                    if kd not in other_definitions:
-                        foreign_keys[field.name] = kd.replace("\n\t", ' ')
-                else:
-                    fd = field.definition.strip()
-                if fd != definitions.get(field.name):
-                    different_attrs[field.name] = fd
-                i += 1
+_COLUMN_DEFINITION = re.compile(r'^\s*`([^`]+)`\s+(.+?),?$', re.M)
+_OTHER_DEFINITION = re.compile(r'^\s*([^`\s].*?),?$', re.M)
+
+_schema_cache: dict[str, tuple[str, dict[str, str], set[str]]] = {}
+"""Dict[`str`, Tuple]: `SHOW CREATE TABLE` of each table with its parsed column and other definitions.
+Kept across migrations while the table's creation and update times stay the same, and dropped after an ALTER TABLE run here."""
+_schema_versions: dict[str, tuple[Any, Any]] = {}
+"Dict[`str`, Tuple]: `CREATE_TIME` and `UPDATE_TIME` of each table when `_schema_cache` was last checked."
+
+
+def _refresh_schema_cache() -> None:
+    """Drops the cached definitions of the tables that were created or changed since the last check.
+    A single query on `INFORMATION_SCHEMA.TABLES` replaces a `SHOW CREATE TABLE` per table when nothing changed."""
+    with _acquire() as sess:
+        sess.execute("SELECT TABLE_NAME, CREATE_TIME, UPDATE_TIME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = DATABASE();")
+        versions = {row["TABLE_NAME"]: (row["CREATE_TIME"], row["UPDATE_TIME"]) for row in sess.cursor.fetchall()}
+
+    for table in list(_schema_cache):
+        if _schema_versions.get(table) != versions.get(table):
+            _schema_cache.pop(table, None)
+    _schema_versions.clear()
+    _schema_versions.update(versions)
+
+
+def _table_definitions(model: type[Model]) -> tuple[str, dict[str, str], set[str]]:
+    "Returns the `CREATE TABLE` query of the model's table, its column definitions by name and its other definitions."
+    if (cached := _schema_cache.get(model.__name__)) is not None:
+        return cached
+
+    with _acquire() as sess:
+        sess.execute(f'SHOW CREATE TABLE {model.__name__};')
+        table_creation_query: str = sess.cursor.fetchone()['Create Table']
+    # The lines between `CREATE TABLE ... (` and `) ENGINE=...`
+    body = table_creation_query.split('\n', 1)[1].rsplit('\n', 1)[0]
+    definitions: dict[str, str] = dict(_COLUMN_DEFINITION.findall(body))
+    other_definitions: set[str] = set(_OTHER_DEFINITION.findall(body))
+
+    cached = _schema_cache[model.__name__] = (table_creation_query, definitions, other_definitions)
+    return cached
+
+
+@dataclass
+class Diff:
+    "A difference between a model and its table, found by `plan_migration`."
+    model: type[Model]
+    kind: str
+    "`str`: `add` or `modify` for a field whose column is missing or different, `extra` for a column that no field has, `foreign_key` for a missing constraint."
+    column: str
+    definition: str
+    "`str`: The definition in the model, or in the table for `extra`."
+    db_definition: str | None = None
+    "`str | None`: The definition in the table, if the column exists."
+
+    @property
+    def key(self) -> str:
+        "`str`: `Model.column` (`Model.column:foreign_key` for a constraint), the key of the decision for this difference."
+        if self.kind == "foreign_key":
+            return f'{self.model.__name__}.{self.column}:foreign_key'
+        return f'{self.model.__name__}.{self.column}'
+
+
+_DECISIONS = {
+    "add": {"add", "rename", "skip"},
+    "modify": {"modify", "skip"},
+    "extra": {"rename", "drop", "skip"},
+    "foreign_key": {"add", "skip"},
+}
+"Dict[`str`, Set[`str`]]: The actions that can be decided for each kind of `Diff`."
+
+
+def plan_migration() -> list[Diff]:
+    "Compares every model with its table and returns the differences, without changing anything."
+    # The tables may have been changed outside this process since the last migration.
+    _refresh_schema_cache()
+    plan: list[Diff] = []
+
+    for model in models:
+        _, definitions, other_definitions = _table_definitions(model)
+        field_names: set[str] = set()
+        extras: list[Diff] = []
+        foreign_keys: list[Diff] = []
+
+        for field in model.fields.values():
+            field_names.add(field.name)
+            if isinstance(field, ForeignKey):
+                fd, kd = field.definition.split(",\n\t", 1)
+                if kd not in other_definitions:
+                    foreign_keys.append(Diff(model, "foreign_key", field.name, kd.replace("\n\t", ' ')))
+            else:
+                fd = field.definition.strip()
+
+            if (db_definition := definitions.get(field.name)) is None:
+                plan.append(Diff(model, "add", field.name, fd))
+            elif fd != db_definition:
+                plan.append(Diff(model, "modify", field.name, fd, db_definition))
+
+        for col, db_definition in definitions.items():
+            if col not in field_names:
+                extras.append(Diff(model, "extra", col, db_definition, db_definition))
+
+        plan += extras + foreign_keys
+    return plan
+
+
+def _referencing_keys(model: type[Model], columns: list[str]) -> list[dict[str, Any]]:
+    "Returns the foreign keys of other tables that reference any of `columns` of the model's table."
+    with _acquire() as sess:
+        sess.execute(
+            "SELECT TABLE_NAME, COLUMN_NAME, CONSTRAINT_NAME"
+            "\nFROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE"
+            "\nWHERE REFERENCED_TABLE_NAME = %s"
+            f'\nAND REFERENCED_COLUMN_NAME IN ({", ".join(["%s"] * len(columns))})'
+            "\n;",
+            (model.__name__, *columns)
+        )
+        return sess.cursor.fetchall()
+
+
+def migration_queries(plan: list[Diff], decisions: dict[str, str]) -> list[str]:
+    """Returns the queries that carry out `decisions` on the differences in `plan`, with one ALTER TABLE per model.
+    Decisions are keyed by `Diff.key`; a difference without one is skipped.
+    - `add`: `add`, `add FIRST`, `add AFTER <column>` or `rename <column in the table>`
+    - `modify`: `modify`
+    - `extra`: `drop` or `rename <new name>`
+    - `foreign_key`: `add`"""
+    by_model: dict[type[Model], list[Diff]] = {}
+    for diff in plan:
+        by_model.setdefault(diff.model, []).append(diff)
+
+    queries: list[str] = []
+    for model, diffs in by_model.items():
+        _, definitions, _ = _table_definitions(model)
+        pks = [pk.name for pk in model.primary_keys]
+        renamed: set[str] = set()
+        parts: list[str] = []
+
+        for diff in diffs:
+            action, _, arg = decisions.get(diff.key, "skip").partition(' ')
+            if action not in _DECISIONS[diff.kind]:
+                raise ValueError(f'Invalid decision for {diff.key}: {decisions[diff.key]}')
+
+            if diff.kind == "add" and action == "add":
+                after = arg.removeprefix("AFTER ")
+                if arg and arg != "FIRST" and (after == arg or after not in definitions):
+                    raise ValueError(f'Invalid position for {diff.key}: {arg!r}; expected FIRST or AFTER <column in the table>')
+                if after != arg:
+                    arg = f'AFTER `{after}`'
+                parts.append(f'ADD `{diff.column}` {diff.definition} {arg}'.rstrip())
+
+                if diff.column in pks:
+                    if other_pks := [pk for pk in pks if pk != diff.column]:
+                        for fk in _referencing_keys(model, other_pks):
+                            queries.append(f'ALTER TABLE {fk["TABLE_NAME"]}\n\tDROP KEY {fk["CONSTRAINT_NAME"]}\n;\n')
+                    parts.append('DROP PRIMARY KEY')
+                    parts.append(f'ADD PRIMARY KEY({", ".join(pks)})')
+            elif diff.kind == "add" and action == "rename":
+                if arg not in definitions:
+                    raise ValueError(f'{arg!r} is not a column of {model.__name__} to rename to {diff.column}')
+                parts.append(f'CHANGE {arg} {diff.column} {diff.definition}')
+                renamed.add(arg)
+            elif diff.kind == "modify" and action == "modify":
+                parts.append(f'MODIFY `{diff.column}` {diff.definition}')
+            elif diff.kind == "extra" and diff.column not in renamed:
+                if action == "rename":
+                    if not _IDENTIFIER.fullmatch(arg):
+                        raise ValueError(f'{arg!r} is not a valid column name')
+                    parts.append(f'CHANGE `{diff.column}` `{arg}` {diff.definition}')
+                elif action == "drop":
+                    parts.append(f'DROP `{diff.column}`')
+            elif diff.kind == "foreign_key" and action == "add":
+                parts.append(f'ADD {diff.definition}')
+
+        if parts:
+            queries.append(f'ALTER TABLE {model.__name__}\n\t' + ',\n\t'.join(parts) + '\n;')
+    return queries
+
+
+def apply_migration(plan: list[Diff], decisions: dict[str, str], confirm: bool = True) -> None:
+    "Runs `migration_queries(plan, decisions)`. With `confirm`, the queries are shown and run only once confirmed."
+    if not (queries := migration_queries(plan, decisions)):
+        return
+    if confirm:
+        _check_query(queries)
+        return
 
-            for col in definitions:
-                if col not in field_names and col not in different_attrs:
-                    different_columns[col] = definitions[col]
+    with _acquire() as sess:
+        for query in queries:
+            sess.execute(query)
+    _schema_cache.clear()
+
+
+def _ask(diff: Diff, extras: list[Diff]) -> str | None:
+    "Asks what to do with `diff` and returns the decision, or `None` to abort."
+    prompt = f'Different attribute detected on `{diff.model.__name__}`: `{diff.column}` {diff.definition}'
+    if diff.kind == "extra":
+        prompt = f'Different column detected on `{diff.model.__name__}`: `{diff.column}` {diff.definition}'
+    elif diff.kind == "foreign_key":
+        prompt = f'Foreign key detected on `{diff.model.__name__}`: {diff.definition}'
+    line = '-' * len(prompt)
+    print(f'{line}\n{prompt}\n{line}')
+
+    if diff.kind == "add":
+        print("< Different Column From Model >", '\n\t'.join([f'{e.column} {e.definition}' for e in extras]), sep="\n\t")
+        rep = input("1). Add new column\n2). Rename column\n3). Skip\n4). Abort\nNumber: ")
+        if rep == '1':
+            _, definitions, _ = _table_definitions(diff.model)
+            print("< Other Columns >\n\t" + '\n\t'.join([f'`{k}` {v}' for k, v in definitions.items()]))
+            print("< Model Definition >\n\t" + '\n\t'.join([f'`{v.name}` {v.definition}' for v in diff.model.fields.values()]))
+            pos = input("Column Position: ")
+            if pos == "FIRST":
+                return "add FIRST"
+            if pos not in definitions:
+                raise ValueError("Invalid position")
+            return f'add AFTER {pos}'
+        elif rep == '2':
+            column_to_rename = input("Column to rename: ")
+            for extra in extras:
+                if extra.column == column_to_rename:
+                    extras.remove(extra)
+                    return f'rename {column_to_rename}'
+            raise ValueError(f'{column_to_rename} is not a column to rename')
+        elif rep == '3':
+            return "skip"
+    elif diff.kind == "modify":
+        print(
+            "< Equal Name >",
+            f'CODE: `{diff.column}` {diff.definition}',
+            f'DB: `{diff.column}` {diff.db_definition}',
+            sep='\n'
+        )
+        rep = input("1). Modify column\n2). Skip\n3). Abort\n")
+        if rep in ('1', '2'):
+            return "modify" if rep == '1' else "skip"
+    elif diff.kind == "extra":
+        rep = input("1). Rename column\n2). Drop column\n3). Skip\n4). Abort\nNumber: ")
+        if rep == '1':
+            return f'rename {input("New name: ")}'
+        elif rep in ('2', '3'):
+            return "drop" if rep == '2' else "skip"
+    else:
+        rep = input("1). Add Foreign Key\n2). Skip\n3). Abort\nNumber: ")
+        if rep in ('1', '2'):
+            return "add" if rep == '1' else "skip"
+    return None
 
-            print(table_creation_query) # This prints the query that creates the table
-            queries = []
-            query = f'ALTER TABLE {model.__name__}'
 
-            if not (different_columns and different_attrs):
-                continue
+def migrate() -> None:
+    "Asks what to do with each difference found by `plan_migration` and applies the decisions, one model at a time."
+    by_model: dict[type[Model], list[Diff]] = {}
+    for diff in plan_migration():
+        by_model.setdefault(diff.model, []).append(diff)
 
-            for attr in different_attrs:
-                prompt = f'Different attribute detected on `{model.__name__}`: `{attr}` {different_attrs[attr]}'
-                print('-' * len(prompt))
-                print(prompt)
-                print('-' * len(prompt))
-
-                if attr not in definitions:
-                    print("< Different Column From Model >", '\n\t'.join([f'{k} {v}' for k, v in different_columns.items()]), sep="\n\t")
-                    rep = input("1). Add new column\n2). Rename column\n3). Skip\n4). Abort\nNumber: ")
-                    if rep == '1':
-                        query += f'\n\tADD `{attr}` {different_attrs[attr]}'
-                        print("< Other Columns >\n\t" + '\n\t'.join([f'`{k}` {v}' for k, v in definitions.items()]))
-                        print("< Model Definition >\n\t" + '\n\t'.join([f'`{v.name}` {v.definition}' for v in model.fields.values()]))
-                        pos = input("Column Position: ")
-                        if pos == "FIRST":
-                            query += " FIRST"
-                        else:
-                            if pos not in definitions:
-                                raise ValueError("Invalid position")
-                            query += f' AFTER {pos}'
-                        pks = [pk.name for pk in model.primary_keys]
-                        if attr in pks:
-                            for pk in pks:
-                                if pk != attr:
-                                    _sessions[0].execute("SELECT TABLE_NAME, COLUMN_NAME, CONSTRAINT_NAME" 
-                                        + "\nFROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE"
-                                        + f'\nWHERE REFERENCED_TABLE_NAME = \'{model.__name__}\''
-                                        + f'\nAND REFERENCED_COLUMN_NAME = \'{pk}\''
-                                        + "\n;"
-                                    )
-                                    for fk in _sessions[0].cursor.fetchall():
-                                        queries.append(f'ALTER TABLE {fk["TABLE_NAME"]}\n\tDROP KEY {fk["CONSTRAINT_NAME"]}\n;\n')
-                            query += f',\n\tDROP PRIMARY KEY,\n\tADD PRIMARY KEY({", ".join(pks)})'
-                    elif rep == '2':
-                        column_to_rename = input("Column to rename: ")
-                        query += f'\n\tCHANGE {column_to_rename} {attr} {different_attrs[attr]}'
-                        del different_columns[column_to_rename]
-                    elif rep == '3':
-                        continue
-                    else:
-                        print("종료")
-                        return
-                else:
-                    print(
-                        "< Equal Name >",
-                        f'CODE: `{attr}` {different_attrs[attr]}',
-                        f'DB: `{attr}` {definitions[attr]}',
-                        sep='\n'
-                    )
-                    rep = input("1). Modify column\n2). Skip\n3). Abort\n")
-                    if rep == '1':
-                        query += f'\n\tMODIFY `{attr}` {different_attrs[attr]}'
-                    elif rep == '2':
-                        continue
-                    else:
-                        print("종료")
-                        return
-                query += ','
-            
-            for col in different_columns:
-                prompt = f'Different column detected on `{model.__name__}`: `{col}` {different_columns[col]}'
-                print('-' * len(prompt))
-                print(prompt)
-                print('-' * len(prompt))
-                rep = input("1). Rename column\n2). Drop column\n3). Skip\n4). Abort\nNumber: ")
-                if rep == '1':
-                    new_name = input("New name: ")
-                    query += f'\n\tCHANGE `{col}` `{new_name}` {different_columns[col]}'
-                elif rep == '2':
-                    query += f'\n\tDROP `{col}`'
-                elif rep == '3':
-                    continue
-                else:
-                    print("종료")
-                    return
-                query += ','
-            
-            for fk in foreign_keys:
-                prompt = f'Foreign key detected on `{model.__name__}`: {foreign_keys[fk]}'
-                print('-' * len(prompt))
-                print(prompt)
-                print('-' * len(prompt))
-                rep = input("1). Add Foreign Key\n2). Skip\n3). Abort\nNumber: ")
-                if rep == '1':
-                    query += f'\n\tADD {foreign_keys[fk]}'
-                elif rep == '2':
-                    continue
-                else:
+    try:
+        for model, diffs in by_model.items():
+            print(_table_definitions(model)[0]) # This prints the query that creates the table
+            extras = [diff for diff in diffs if diff.kind == "extra"]
+            decisions: dict[str, str] = {}
+
+            for diff in diffs:
+                if diff.kind == "extra" and diff not in extras:
+                    continue  # Renamed to one of the fields
+                if (decision := _ask(diff, extras)) is None:
                     print("종료")
                     return
-                query += ','
+                decisions[diff.key] = decision
 
-            queries.append(query.removesuffix(',') + "\n;")
-            _check_query(queries)
+            apply_migration(diffs, decisions)
     except KeyboardInterrupt:
         print("강제 종료")
         return
-
@@ -31,7 +31,7 @@ class MemoryStore(redis.Redis):
         value: bytes = self.get(__key)
         if value is None:
             raise KeyError(__key)
-        if value.isdigit:
+        if value.isdigit():
             return int(value)
         else:
             return value.decode()
@@ -41,6 +41,15 @@ class MemoryStore(redis.Redis):
         if isinstance(__value, list): return self.lpush(__key, *__value)
         return self.set(__key, __value)
 
+    def bulk_set(self, mapping: dict[_Key, Any]) -> None:
+        "Same as setting each item with `store[key] = value`, but sent in a single round-trip."
+        with self.pipeline(transaction=False) as pipe:
+            for key, value in mapping.items():
+                if isinstance(value, dict): pipe.mset(value)
+                elif isinstance(value, list): pipe.lpush(key, *value)
+                else: pipe.set(key, value)
+            pipe.execute()
+
     def __delitem__(self, __key: str) -> None:
         self.delete(__key)
 